@@ -1,8 +1,14 @@
 import streamlit as st
-import altair as alt
-import duckdb
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from utilities import snowflake_connection_helper
-from utilities import run_snowflake_query
+from utilities import run_snowflake_query_arrow
+from utilities import run_duckdb_query
+from utilities import run_sqlite_query
+from utilities import get_sqlite_connection
+from snow_to_duckdb import refresh_cache
 
 st.title("Snowflake to SQLite & DuckDB")
 st.write(
@@ -21,64 +27,98 @@ ORDER BY 2 DESC
 LIMIT 5
 """
 
-st.code(query)
-
-st.subheader("Snowflake")
-snow_conn = snowflake_connection_helper()
-snow_df = run_snowflake_query(snow_conn, query)
-snow_df = snow_df.sort_values(by="TOTAL_ORDERS", ascending=False)
-
-st.dataframe(snow_df)
-
-snow_orders_chart = (
-    alt.Chart(snow_df)
-    .mark_bar()
-    .encode(
-        x="NAME",
-        y=alt.Y("TOTAL_ORDERS", sort=None),
-        color=alt.value("#F63366"),
-    )
-)
-
-st.altair_chart(snow_orders_chart, use_container_width=True)
+# Most rows sent to the dataframe and chart for a single result
+max_rows = 2000
 
+# Vega-Lite spec for the results bar chart, built once instead of through Altair
+bar_spec = {
+    "mark": "bar",
+    "encoding": {
+        "x": {"field": "name", "type": "nominal"},
+        "y": {"field": "total_orders", "type": "quantitative", "sort": None},
+        "color": {"value": "#F63366"},
+    },
+}
 
-# Query and display the data you inserted
-st.subheader("SQL Lite")
-sqlite_conn = st.connection("jaffle_shop", type="sql")
-sqlite_df = sqlite_conn.query(query)
-sqlite_df = sqlite_df.sort_values(by="TOTAL_ORDERS", ascending=False)
 
-st.dataframe(sqlite_df)
+# Each backend returns its result and an optional caption to show with it
+def query_snowflake(snow_conn, query):
+    return run_snowflake_query_arrow(snow_conn, query), None
 
-sqllite_orders_chart = (
-    alt.Chart(sqlite_df)
-    .mark_bar()
-    .encode(
-        x="NAME",
-        y=alt.Y("TOTAL_ORDERS", sort=None),
-        color=alt.value("#F63366"),
-    )
-)
-
-st.altair_chart(sqllite_orders_chart, use_container_width=True)
 
+def query_sqlite(sqlite_conn, query):
+    return run_sqlite_query(sqlite_conn, query), None
 
-st.subheader("DuckDB")
-duckdb_conn = duckdb.connect("jaffle_shop.duckdb")
-duckdb_df = duckdb_conn.execute(query).df()
-duckdb_df = duckdb_df.sort_values(by="TOTAL_ORDERS", ascending=False)
 
-st.dataframe(duckdb_df)
+def query_duckdb(snow_conn, query):
+    caption = None
+    try:
+        # Re-copy expired tables from Snowflake before querying the local cache
+        if refresh_cache("jaffle_shop.duckdb", connection=snow_conn):
+            run_duckdb_query.clear()
+    except Exception as e:
+        # Serve the tables already on disk if Snowflake can't be reached
+        caption = f"Refresh from Snowflake failed, showing cached data that may be stale: {e}"
+    return run_duckdb_query("jaffle_shop.duckdb", query), caption
 
-duckdb_orders_chart = (
-    alt.Chart(duckdb_df)
-    .mark_bar()
-    .encode(
-        x="NAME",
-        y=alt.Y("TOTAL_ORDERS", sort=None),
-        color=alt.value("#F63366"),
-    )
-)
 
-st.altair_chart(duckdb_orders_chart, use_container_width=True)
+# Resolve the cached connections here, on the script thread, so any
+# cache-miss spinner renders in page order rather than from a worker
+snow_conn = snowflake_connection_helper()
+sqlite_conn = get_sqlite_connection()
+
+# Section title and query function for each backend, in page order
+backends = {
+    "Snowflake": partial(query_snowflake, snow_conn),
+    "SQL Lite": partial(query_sqlite, sqlite_conn),
+    "DuckDB": partial(query_duckdb, snow_conn),
+}
+
+
+def render_results(df, chart_spec, caption=None):
+    if caption:
+        st.caption(caption)
+
+    # Bound the browser-side work for large results; slicing works for pandas and Arrow
+    if len(df) > max_rows:
+        st.caption(f"Showing the first {max_rows:,} of {len(df):,} rows.")
+        df = df[:max_rows]
+
+    st.dataframe(df)
+    st.vega_lite_chart(df, chart_spec, width="stretch")
+
+
+def run_demo(query, chart_spec):
+    """Run one query against every backend and render each result.
+
+    Args:
+        query (str): The SQL query to send to each backend
+        chart_spec (dict): Vega-Lite spec used to chart each result
+    """
+    st.code(query)
+
+    # Lay out the sections up front so each can be filled as soon as its query finishes
+    sections = {}
+    for name in backends:
+        sections[name] = st.container()
+        sections[name].subheader(name)
+
+    # Worker threads need the script context to use the Streamlit caches
+    ctx = get_script_run_ctx()
+
+    # Run the remote and local queries concurrently so the page waits on the slowest only
+    with ThreadPoolExecutor(
+        max_workers=len(backends),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    ) as executor:
+        futures = {
+            executor.submit(run_query, query): name
+            for name, run_query in backends.items()
+        }
+        for future in as_completed(futures):
+            with sections[futures[future]]:
+                df, caption = future.result()
+                render_results(df, chart_spec, caption)
+
+
+run_demo(query, bar_spec)
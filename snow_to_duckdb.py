@@ -1,7 +1,11 @@
 import duckdb
-import pandas as pd
-from decimal import Decimal
-from datetime import date, datetime
+import pyarrow as pa
+import queue
+import tempfile
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from utilities import snowflake_connection_helper
 
 # List of table names to fetch and write
@@ -14,172 +18,312 @@ table_names = [
     "supplies",
 ]
 
+# Number of tables fetched from Snowflake concurrently
+max_workers = 6
+
 # DuckDB database file
 duckdb_path = "jaffle_shop.duckdb"
 
-def map_snowflake_to_duckdb_type(snowflake_type):
-    """
-    Map Snowflake data types to their equivalent DuckDB data types.
+# Large tables fetched as parallel partitions, mapped to the column whose
+# hash splits them
+partition_keys = {
+    "items": "id",
+    "orders": "id",
+}
 
-    Args:
-        snowflake_type (str): Snowflake data type to convert
+# Number of partitions fetched concurrently for each partitioned table
+partition_count = 8
 
-    Returns:
-        str: Corresponding DuckDB data type
-    """
-    snowflake_type = snowflake_type.upper()
+# Unload tables to Parquet on a Snowflake stage and load the files with
+# DuckDB's native reader instead of streaming rows through Python
+parquet_unload = False
 
-    # Handle VARCHAR types
-    if "VARCHAR" in snowflake_type or "TEXT" in snowflake_type:
-        return "VARCHAR"
+# Snowflake stage location used for Parquet unloads
+parquet_stage = "@~/jaffle"
 
-    # Handle NUMBER types
-    elif "NUMBER" in snowflake_type:
-        # Check if it's a decimal number
-        if "," in snowflake_type:
-            return "DOUBLE"
-        else:
-            return "BIGINT"
+# Held while refresh_cache copies tables so only one refresh runs at a time
+refresh_lock = threading.Lock()
 
-    # Handle TIMESTAMP types
-    elif "TIMESTAMP_NTZ" in snowflake_type:
-        return "TIMESTAMP"
-    elif "TIMESTAMP" in snowflake_type:
-        return "TIMESTAMP"
+def create_table_from_arrow(conn, table_name, arrow_table):
+    """
+    Create (or replace) a DuckDB table shaped like an Arrow table.
 
-    # Handle DATE type
-    elif "DATE" in snowflake_type:
-        return "DATE"
+    DuckDB takes the column types from the Arrow schema. Snowflake picks the
+    narrowest integer type per result batch, so integer columns are widened
+    to BIGINT to fit every later batch. Timestamps arrive in nanoseconds,
+    which would create TIMESTAMP_NS columns, so they are cast to
+    microseconds for DuckDB's standard TIMESTAMP type.
+    """
+    fields = []
+    for field in arrow_table.schema:
+        if pa.types.is_integer(field.type):
+            field = field.with_type(pa.int64())
+        elif pa.types.is_timestamp(field.type):
+            field = field.with_type(pa.timestamp("us", field.type.tz))
+        fields.append(field)
+
+    # Unsafe so nanoseconds are truncated rather than rejected
+    conn.register("source_batch", arrow_table.cast(pa.schema(fields), safe=False))
+    try:
+        conn.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM source_batch")
+    finally:
+        conn.unregister("source_batch")
+
+def fetch_data_from_snowflake(connection, table_name, where=None):
+    """
+    Fetch data from a specific table in Snowflake as a stream of Arrow tables.
+
+    Each Arrow table holds one result batch, so only a single batch is held
+    in memory at a time regardless of table size.
+    """
+    query = f"SELECT * FROM {table_name}"
+    if where:
+        query += f" WHERE {where}"
+    cursor = connection.cursor()
+    cursor.execute(query)
 
-    # Handle BOOLEAN type
-    elif "BOOLEAN" in snowflake_type:
-        return "BOOLEAN"  # DuckDB has native BOOLEAN support
+    empty = True
+    for arrow_table in cursor.fetch_arrow_batches():
+        empty = False
+        yield arrow_table
 
-    # Default to VARCHAR for unknown types
-    return "VARCHAR"
+    if empty:
+        # Still yield an empty table so callers get the column layout
+        yield cursor.fetch_arrow_all(force_return_table=True)
 
-def fetch_table_schema(connection, table_name):
+def fetch_partitioned_data_from_snowflake(connection, table_name, key):
     """
-    Fetch the schema of a specific table from Snowflake.
+    Fetch a table from Snowflake as parallel hash partitions of one column.
+
+    Each of the partition_count partitions is a separate query on its own
+    thread, so a large table is no longer limited by a single result
+    stream. Batches are yielded to the caller in arrival order.
 
     Args:
         connection (snowflake.connector.connection.SnowflakeConnection): Active Snowflake connection
-        table_name (str): Name of the table to fetch schema for
+        table_name (str): Name of the table to fetch
+        key (str): Column whose hash assigns rows to partitions
 
-    Returns:
-        list: List of tuples containing column information (name, type, etc.)
+    Yields:
+        pyarrow.Table: One result batch from any partition
     """
-    query = f"DESCRIBE TABLE {table_name}"
-    cursor = connection.cursor()
-    cursor.execute(query)
-    schema = cursor.fetchall()
-    return schema
+    # Bounded so the partitions can't run far ahead of the caller
+    batches = queue.Queue(maxsize=partition_count * 2)
+    stop = threading.Event()
 
-def create_table_in_duckdb(table_name, schema):
+    def fetch_partition(partition):
+        where = f"MOD(ABS(HASH({key})), {partition_count}) = {partition}"
+        try:
+            for arrow_table in fetch_data_from_snowflake(connection, table_name, where):
+                if stop.is_set():
+                    return
+                batches.put(arrow_table)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            batches.put(None)
+
+    with ThreadPoolExecutor(max_workers=partition_count) as executor:
+        futures = [
+            executor.submit(fetch_partition, partition)
+            for partition in range(partition_count)
+        ]
+        try:
+            remaining = partition_count
+            while remaining:
+                arrow_table = batches.get()
+                if arrow_table is None:
+                    remaining -= 1
+                else:
+                    yield arrow_table
+        finally:
+            # Unblock partitions waiting on a full queue so they can exit
+            stop.set()
+            while not all(future.done() for future in futures):
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    # Re-raise the first error from a partition, if any
+    for future in futures:
+        future.result()
+
+def write_data_to_duckdb(conn, arrow_table, table_name):
     """
-    Create a table in DuckDB based on the Snowflake schema.
+    Insert data into the specified DuckDB table.
+
+    DuckDB scans the Arrow buffers directly and casts each column to the
+    table's declared type, so no Python-level conversion is needed.
     """
-    conn = duckdb.connect(duckdb_path)
-    
-    columns_with_types = ", ".join(
-        [f'{col[0]} {map_snowflake_to_duckdb_type(col[1])}' for col in schema]
-    )
-    create_table_query = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_with_types})"
-    conn.execute(create_table_query)
-    conn.commit()
-    conn.close()
+    conn.from_arrow(arrow_table).insert_into(table_name)
 
-def convert_value(value, snowflake_type):
+def unload_table_to_parquet(connection, table_name, target_dir):
     """
-    Convert a value from Snowflake format to DuckDB compatible format.
+    Unload a Snowflake table to Parquet files and download them locally.
 
     Args:
-        value: The value to convert
-        snowflake_type (str): The Snowflake data type of the value
+        connection (snowflake.connector.connection.SnowflakeConnection): Active Snowflake connection
+        table_name (str): Name of the table to unload
+        target_dir (str): Local directory to download the Parquet files into
 
     Returns:
-        The converted value suitable for DuckDB storage
+        list: Paths of the downloaded Parquet files
     """
-    if value is None:
-        return None
+    stage_path = f"{parquet_stage}/{table_name}/"
+    cursor = connection.cursor()
 
-    snowflake_type = snowflake_type.upper()
+    # Clear files left behind by a previous unload of this table
+    cursor.execute(f"REMOVE {stage_path}")
+    cursor.execute(
+        f"COPY INTO {stage_path} FROM {table_name} "
+        "FILE_FORMAT=(TYPE=PARQUET) OVERWRITE=TRUE HEADER=TRUE"
+    )
+    cursor.execute(f"GET {stage_path} 'file://{Path(target_dir).as_posix()}/'")
 
-    # Handle BOOLEAN
-    if "BOOLEAN" in snowflake_type:
-        return bool(value)  # DuckDB supports native boolean
+    return sorted(str(path) for path in Path(target_dir).rglob("*.parquet"))
 
-    # Handle NUMBER types
-    if "NUMBER" in snowflake_type:
-        if isinstance(value, Decimal):
-            if "," in snowflake_type:  # decimal places specified
-                return float(value)
-            return int(value)
+def load_table_from_parquet(conn, table_name, parquet_files):
+    """
+    Replace a DuckDB table with the contents of local Parquet files.
 
-    # Handle TIMESTAMP_NTZ
-    if "TIMESTAMP_NTZ" in snowflake_type:
-        if isinstance(value, (datetime, date)):
-            return value
-        # Handle string timestamps
-        try:
-            return datetime.fromisoformat(str(value))
-        except (ValueError, TypeError):
-            return None
+    DuckDB reads the column types straight from the Parquet metadata.
+    """
+    conn.execute(
+        f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM read_parquet(?)",
+        [parquet_files],
+    )
 
-    return value
+def copy_table(connection, duckdb_conn, table_name):
+    """
+    Copy a single table from Snowflake to DuckDB, replacing any previous copy.
 
-def fetch_data_from_snowflake(connection, table_name):
+    Runs in a worker thread, so it writes through its own DuckDB cursor;
+    a DuckDB connection must not be shared between threads. The table is
+    swapped in a single transaction, so readers never see a partial copy.
     """
-    Fetch all data from a specific table in Snowflake.
+    conn = duckdb_conn.cursor()
+
+    try:
+        print(f"Processing table: {table_name}")
+        conn.begin()
+
+        loaded = False
+        if parquet_unload:
+            with tempfile.TemporaryDirectory() as target_dir:
+                parquet_files = unload_table_to_parquet(
+                    connection, table_name, target_dir
+                )
+                # Empty tables unload no files; create them from the query below
+                if parquet_files:
+                    load_table_from_parquet(conn, table_name, parquet_files)
+                    loaded = True
+
+        if not loaded:
+            # Stream data from Snowflake one batch at a time
+            if table_name in partition_keys:
+                batches = fetch_partitioned_data_from_snowflake(
+                    connection, table_name, partition_keys[table_name]
+                )
+            else:
+                batches = fetch_data_from_snowflake(connection, table_name)
+
+            # Close the stream on failure too, so partition fetches stop and drain
+            with closing(batches):
+                created = False
+                for arrow_table in batches:
+                    if not created:
+                        # Create the DuckDB table from the first batch's schema
+                        create_table_from_arrow(conn, table_name, arrow_table)
+                        created = True
+                    else:
+                        # Write to DuckDB
+                        write_data_to_duckdb(conn, arrow_table, table_name)
+
+        conn.execute(
+            "INSERT OR REPLACE INTO _cache_meta VALUES (?, now())", [table_name]
+        )
+        conn.commit()
+        print(f"Data successfully written for table: {table_name}")
+    finally:
+        conn.close()
+
+def copy_tables(connection, duckdb_conn, names):
     """
-    query = f"SELECT * FROM {table_name}"
-    cursor = connection.cursor()
-    cursor.execute(query)
-    data = cursor.fetchall()
-    column_names = [desc[0] for desc in cursor.description]
-    return data, column_names
+    Copy the given tables from Snowflake to DuckDB concurrently.
 
-def convert_data_for_duckdb(data, schema):
+    Each copy is recorded in the _cache_meta table with its refresh time.
     """
-    Convert all data to DuckDB-compatible formats based on schema.
+    duckdb_conn.execute(
+        "CREATE TABLE IF NOT EXISTS _cache_meta "
+        "(table_name VARCHAR PRIMARY KEY, updated_at TIMESTAMPTZ)"
+    )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(copy_table, connection, duckdb_conn, table_name)
+            for table_name in names
+        ]
+        for future in futures:
+            future.result()
+
+def find_stale_tables(duckdb_conn, ttl_seconds):
+    """
+    List the tables that are missing from _cache_meta or older than ttl_seconds.
+    """
+    fresh_tables = set()
+    if duckdb_conn.execute(
+        "SELECT 1 FROM information_schema.tables WHERE table_name = '_cache_meta'"
+    ).fetchone():
+        fresh_tables = {
+            row[0]
+            for row in duckdb_conn.execute(
+                "SELECT table_name FROM _cache_meta "
+                "WHERE updated_at > now() - to_seconds(?)",
+                [ttl_seconds],
+            ).fetchall()
+        }
+
+    return [name for name in table_names if name not in fresh_tables]
+
+def refresh_cache(duckdb_path, ttl_seconds=3600, connection=None):
+    """
+    Re-copy any DuckDB tables that are missing or older than ttl_seconds.
+
+    Lets a long-running app serve queries from DuckDB and only go back to
+    Snowflake once the local copy has expired. The Snowflake connection
+    is left open for the caller.
+
+    Refreshes are serialized across threads, so concurrent sessions that
+    find the same expired tables copy them once instead of conflicting.
 
     Args:
-        data (list): List of tuples containing row data
-        schema (list): List of tuples containing column information
+        duckdb_path (str): DuckDB database file
+        ttl_seconds (int): Maximum age of a table before it is refreshed
+        connection (snowflake.connector.connection.SnowflakeConnection): Connection
+            to copy with; defaults to the shared helper's connection
 
     Returns:
-        list: List of tuples with converted data
+        list: Names of the tables that were refreshed
     """
-    converted_data = []
-    for row in data:
-        converted_row = []
-        for value, column_info in zip(row, schema):
-            snowflake_type = column_info[1]
-            converted_value = convert_value(value, snowflake_type)
-            converted_row.append(converted_value)
-        converted_data.append(tuple(converted_row))
-    return converted_data
+    duckdb_conn = duckdb.connect(duckdb_path)
 
-def write_data_to_duckdb(data, table_name, column_names):
-    """
-    Insert data into the specified DuckDB table.
-    """
-    
-    # Convert data to pandas DataFrame
-    df = pd.DataFrame(data, columns=column_names)
-    
-    conn = duckdb.connect(duckdb_path)
-    
-    # Create a temporary view from the pandas DataFrame
-    conn.register('temp_data', df)
-    
-    # Insert data from the temporary view into the permanent table
-    columns = ', '.join([f'{col}' for col in column_names])
-    insert_query = f"INSERT INTO {table_name} ({columns}) SELECT * FROM temp_data"
-    conn.execute(insert_query)
-    
-    conn.commit()
-    conn.close()
+    try:
+        if not find_stale_tables(duckdb_conn, ttl_seconds):
+            return []
+
+        with refresh_lock:
+            # Another thread may have refreshed the tables while we waited
+            stale_tables = find_stale_tables(duckdb_conn, ttl_seconds)
+            if stale_tables:
+                if connection is None:
+                    connection = snowflake_connection_helper()
+                copy_tables(connection, duckdb_conn, stale_tables)
+
+        return stale_tables
+    finally:
+        duckdb_conn.close()
 
 def main():
     """
@@ -187,28 +331,12 @@ def main():
     """
     snowflake_connection = snowflake_connection_helper()
     print("Snowflake connection established.")
+    duckdb_conn = duckdb.connect(duckdb_path)
 
     try:
-        for table_name in table_names:
-            print(f"Processing table: {table_name}")
-
-            # Fetch Snowflake schema
-            schema = fetch_table_schema(snowflake_connection, table_name)
-
-            # Create table in DuckDB
-            create_table_in_duckdb(table_name, schema)
-
-            # Fetch data from Snowflake
-            data, column_names = fetch_data_from_snowflake(snowflake_connection, table_name)
-
-            # Convert data types based on schema
-            converted_data = convert_data_for_duckdb(data, schema)
-
-            # Write to DuckDB
-            write_data_to_duckdb(converted_data, table_name, column_names)
-
-            print(f"Data successfully written for table: {table_name}")
+        copy_tables(snowflake_connection, duckdb_conn, table_names)
     finally:
+        duckdb_conn.close()
         snowflake_connection.close()
         print("Snowflake connection closed.")
 
@@ -1,6 +1,12 @@
+import queue
+import re
 import sqlite3
-from decimal import Decimal
+import threading
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
+from itertools import islice
 from utilities import snowflake_connection_helper
 
 
@@ -14,9 +20,43 @@ table_names = [
     "supplies",
 ]
 
+# Number of tables fetched from Snowflake concurrently
+max_workers = 6
+
 # SQLite database file
 sqlite_db_path = "jaffle_shop.db"
 
+# Leading keyword of a Snowflake data type, e.g. "NUMBER" in "NUMBER(10,2)"
+snowflake_type_pattern = re.compile(r"^(VARCHAR|TEXT|NUMBER|TIMESTAMP|DATE|BOOLEAN)")
+
+# Scale of a NUMBER type, e.g. "2" in "NUMBER(10,2)"
+number_scale_pattern = re.compile(r",\s*(\d+)\s*\)")
+
+# SQLite column type for each kind reported by snowflake_type_kind
+sqlite_type_map = {
+    "VARCHAR": "TEXT",
+    "TEXT": "TEXT",
+    "NUMBER_INT": "INTEGER",
+    "NUMBER_DEC": "REAL",
+    "TIMESTAMP": "datetime",
+    "DATE": "date",
+    "BOOLEAN": "INTEGER",  # SQLite doesn't have native BOOLEAN, use INTEGER (0/1)
+}
+
+# Rows passed to each executemany call
+sqlite_insert_chunk_size = 10_000
+
+# PRAGMAs applied before the bulk load. The database is a rebuildable local
+# cache, so durability is traded for load speed.
+sqlite_pragmas = [
+    "PRAGMA page_size=65536",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA locking_mode=EXCLUSIVE",
+]
+
 
 # SQLite date/datetime adapters
 def adapt_date(val):
@@ -70,53 +110,48 @@ def fetch_table_schema(connection, table_name):
     return schema
 
 
-def map_snowflake_to_sqlite_type(snowflake_type):
+def snowflake_type_kind(snowflake_type):
     """
-    Map Snowflake data types to their equivalent SQLite data types.
+    Classify a Snowflake data type by its leading keyword.
 
     Args:
-        snowflake_type (str): Snowflake data type to convert
+        snowflake_type (str): Snowflake data type, e.g. "NUMBER(10,2)"
 
     Returns:
-        str: Corresponding SQLite data type
+        str: Key into sqlite_type_map, or None for unknown types. NUMBER is
+        reported as NUMBER_DEC when it has a non-zero scale and NUMBER_INT
+        otherwise.
     """
     snowflake_type = snowflake_type.upper()
+    match = snowflake_type_pattern.match(snowflake_type)
+    if match is None:
+        return None
 
-    # Handle VARCHAR types
-    if "VARCHAR" in snowflake_type or "TEXT" in snowflake_type:
-        return "TEXT"
-
-    # Handle NUMBER types
-    elif "NUMBER" in snowflake_type:
-        # Check if it's a decimal number
-        if "," in snowflake_type:
-            return "REAL"
-        else:
-            return "INTEGER"
+    kind = match.group(1)
+    if kind == "NUMBER":
+        scale = number_scale_pattern.search(snowflake_type)
+        return "NUMBER_DEC" if scale and int(scale.group(1)) else "NUMBER_INT"
+    return kind
 
-    # Handle TIMESTAMP types
-    elif "TIMESTAMP_NTZ" in snowflake_type:
-        return "datetime"
-    elif "TIMESTAMP" in snowflake_type:
-        return "datetime"
 
-    # Handle DATE type
-    elif "DATE" in snowflake_type:
-        return "date"
+def map_snowflake_to_sqlite_type(snowflake_type):
+    """
+    Map Snowflake data types to their equivalent SQLite data types.
 
-    # Handle BOOLEAN type
-    elif "BOOLEAN" in snowflake_type:
-        return "INTEGER"  # SQLite doesn't have native BOOLEAN, use INTEGER (0/1)
+    Args:
+        snowflake_type (str): Snowflake data type to convert
 
+    Returns:
+        str: Corresponding SQLite data type
+    """
     # Default to TEXT for unknown types
-    return "TEXT"
+    return sqlite_type_map.get(snowflake_type_kind(snowflake_type), "TEXT")
 
 
-def create_table_in_sqlite(table_name, schema):
+def create_table_in_sqlite(conn, table_name, schema):
     """
     Create a table in SQLite based on the Snowflake schema.
     """
-    conn = sqlite3.connect(sqlite_db_path, detect_types=sqlite3.PARSE_DECLTYPES)
     cursor = conn.cursor()
 
     columns_with_types = ", ".join(
@@ -126,131 +161,253 @@ def create_table_in_sqlite(table_name, schema):
         f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_with_types})"
     )
     cursor.execute(create_table_query)
-    conn.commit()
-    conn.close()
 
 
-def convert_value(value, snowflake_type):
+def fetch_data_from_snowflake(connection, table_name):
     """
-    Convert a value from Snowflake format to SQLite compatible format.
+    Fetch data from a specific table in Snowflake as a stream of Arrow tables.
+
+    Each Arrow table holds one result batch, so only a single batch is held
+    in memory at a time regardless of table size.
+    """
+    query = f"SELECT * FROM {table_name}"
+    cursor = connection.cursor()
+    cursor.execute(query)
+    yield from cursor.fetch_arrow_batches()
+
+
+def integers_to_int64(column):
+    """
+    Cast an integer column to int64 for SQLite's native INTEGER storage.
+
+    Snowflake sends NUMBER(38,0) values beyond 64 bits as Decimal128.
+    SQLite can't hold those exactly: an INTEGER column rounds them to REAL,
+    which would silently corrupt large IDs, so the load stops instead.
+    """
+    try:
+        return pc.cast(column, pa.int64())
+    except pa.ArrowInvalid as e:
+        raise ValueError(
+            f"Integer values exceed 64 bits and can't be stored exactly in SQLite: {e}"
+        ) from e
+
+
+def timestamps_to_iso(column):
+    """
+    Format a timestamp column as ISO text that convert_datetime can read.
+
+    Arrow prints nanosecond timestamps with nine fractional digits and
+    offsets as "Z" or "-0500", none of which datetime.fromisoformat
+    accepts before Python 3.11. Values are truncated to microseconds, the
+    precision of a Python datetime, and offsets are written as "+HH:MM".
+    """
+    column = pc.cast(column, pa.timestamp("us", column.type.tz), safe=False)
+    text = pc.cast(column, pa.string())
+    text = pc.replace_substring_regex(text, pattern="Z$", replacement="+00:00")
+    return pc.replace_substring_regex(
+        text, pattern=r"([+-]\d{2})(\d{2})$", replacement=r"\1:\2"
+    )
+
+
+def compile_converter(snowflake_type):
+    """
+    Pick the column converter for a Snowflake data type.
+
+    Converters are Arrow compute casts, so a whole column is converted in
+    C without creating a Python object per value.
 
     Args:
-        value: The value to convert
-        snowflake_type (str): The Snowflake data type of the value
+        snowflake_type (str): Snowflake data type of the column
 
     Returns:
-        The converted value suitable for SQLite storage
+        callable: Function converting a pyarrow column for SQLite storage,
+        or None if the column can be stored as-is
     """
-    if value is None:
-        return None
-
-    snowflake_type = snowflake_type.upper()
+    kind = snowflake_type_kind(snowflake_type)
 
     # Handle BOOLEAN
-    if "BOOLEAN" in snowflake_type:
-        return 1 if value else 0
-
-    # Handle NUMBER(38,0)
-    if "NUMBER(38,0)" in snowflake_type:
-        return str(value)  # Store as TEXT to preserve large integers
+    if kind == "BOOLEAN":
+        return lambda column: pc.cast(column, pa.int8())
 
-    # Handle other NUMBER types
-    if "NUMBER" in snowflake_type:
-        if isinstance(value, Decimal):
-            if "," in snowflake_type:  # decimal places specified
-                return float(value)
-            return int(value)
+    # Handle NUMBER types
+    if kind == "NUMBER_DEC":
+        return lambda column: pc.cast(column, pa.float64())
+    if kind == "NUMBER_INT":
+        return integers_to_int64
 
-    # Handle TIMESTAMP_NTZ
-    if "TIMESTAMP_NTZ" in snowflake_type:
-        if isinstance(value, (datetime, date)):
-            return value
-        # Handle string timestamps
-        try:
-            return datetime.fromisoformat(str(value))
-        except (ValueError, TypeError):
-            return None
+    # Handle TIMESTAMP and DATE as ISO text
+    if kind == "TIMESTAMP":
+        return timestamps_to_iso
+    if kind == "DATE":
+        return lambda column: pc.cast(column, pa.string())
 
-    return value
+    return None
 
 
-def fetch_data_from_snowflake(connection, table_name):
+def compile_converters(schema):
     """
-    Fetch all data from a specific table in Snowflake.
+    Resolve the converter for every column of a table once, up front.
+
+    Args:
+        schema (list): List of tuples containing column information
+
+    Returns:
+        list: (column name, converter) pairs for columns needing conversion
     """
-    query = f"SELECT * FROM {table_name}"
-    cursor = connection.cursor()
-    cursor.execute(query)
-    data = cursor.fetchall()
-    column_names = [desc[0] for desc in cursor.description]
-    return data, column_names
+    converters = [(col[0], compile_converter(col[1])) for col in schema]
+    return [(name, converter) for name, converter in converters if converter]
 
 
-def convert_data_for_sqlite(data, schema):
+def convert_batch_for_sqlite(arrow_table, converters):
     """
-    Convert all data to SQLite-compatible formats based on schema.
+    Convert an Arrow table to SQLite-compatible formats.
 
     Args:
-        data (list): List of tuples containing row data
-        schema (list): List of tuples containing column information
+        arrow_table (pyarrow.Table): Data fetched from Snowflake
+        converters (list): Column converters from compile_converters
 
     Returns:
-        list: List of tuples with converted data
+        pyarrow.Table: Table with converted columns
     """
-    converted_data = []
-    for row in data:
-        converted_row = []
-        for value, column_info in zip(row, schema):
-            snowflake_type = column_info[1]
-            converted_value = convert_value(value, snowflake_type)
-            converted_row.append(converted_value)
-        converted_data.append(tuple(converted_row))
-    return converted_data
-
-
-def write_data_to_sqlite(data, table_name):
+    for column_name, converter in converters:
+        index = arrow_table.schema.get_field_index(column_name)
+        arrow_table = arrow_table.set_column(
+            index, column_name, converter(arrow_table.column(index))
+        )
+    return arrow_table
+
+
+def write_data_to_sqlite(conn, arrow_table, table_name):
     """
     Insert data into the specified SQLite table.
+
+    Rows are inserted within the caller's open transaction; nothing is
+    committed here.
     """
-    conn = sqlite3.connect(sqlite_db_path, detect_types=sqlite3.PARSE_DECLTYPES)
     cursor = conn.cursor()
 
-    placeholders = ", ".join(["?" for _ in data[0]])
+    placeholders = ", ".join(["?" for _ in arrow_table.column_names])
     insert_query = f"INSERT INTO {table_name} VALUES ({placeholders})"
-    cursor.executemany(insert_query, data)
+    # Build each column once, with nulls as None, then zip the columns into rows
+    columns = [column.to_pylist() for column in arrow_table.columns]
+    rows = zip(*columns)
 
-    conn.commit()
-    conn.close()
+    # Insert in chunks to bound the rows bound per statement; each chunk is
+    # streamed from the zip iterator without building a list of rows
+    for _ in range(0, arrow_table.num_rows, sqlite_insert_chunk_size):
+        cursor.executemany(insert_query, islice(rows, sqlite_insert_chunk_size))
 
 
-def main():
-    """
-    Main function to orchestrate the data transfer from Snowflake to SQLite.
+def fetch_table(connection, table_name, batches, stop):
     """
-    snowflake_connection = snowflake_connection_helper()
-    print("Snowflake connection established.")
+    Fetch a table from Snowflake and queue it for the SQLite writer.
+
+    Runs in a worker thread. Queues a "create" message with the schema,
+    one "insert" message per converted batch and a final "done" message
+    carrying whether the fetch succeeded.
 
+    Args:
+        connection (snowflake.connector.connection.SnowflakeConnection): Active Snowflake connection
+        table_name (str): Name of the table to fetch
+        batches (queue.Queue): Queue consumed by the SQLite writer
+        stop (threading.Event): Set when the load is being aborted
+    """
+    succeeded = False
     try:
-        for table_name in table_names:
-            print(f"Processing table: {table_name}")
+        # Fetch Snowflake schema
+        schema = fetch_table_schema(connection, table_name)
+        batches.put(("create", table_name, schema))
+        converters = compile_converters(schema)
+
+        # Stream data from Snowflake one batch at a time
+        for arrow_table in fetch_data_from_snowflake(connection, table_name):
+            if stop.is_set():
+                return
 
-            # Fetch Snowflake schema
-            schema = fetch_table_schema(snowflake_connection, table_name)
+            # Convert data types based on schema
+            arrow_table = convert_batch_for_sqlite(arrow_table, converters)
+            batches.put(("insert", table_name, arrow_table))
 
-            # Create table in SQLite
-            create_table_in_sqlite(table_name, schema)
+        succeeded = True
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        batches.put(("done", table_name, succeeded))
 
-            # Fetch data from Snowflake
-            data, _ = fetch_data_from_snowflake(snowflake_connection, table_name)
 
-            # Convert data types based on schema
-            converted_data = convert_data_for_sqlite(data, schema)
+def write_batches_to_sqlite(conn, batches, table_count):
+    """
+    Apply queued messages from the fetch workers until every table is done.
+
+    SQLite allows a single writer, so all writes happen on the calling
+    thread while the workers keep fetching from Snowflake. Progress is
+    printed here too, so lines from different workers don't interleave.
+    """
+    remaining = table_count
+    while remaining:
+        action, table_name, payload = batches.get()
+
+        if action == "create":
+            print(f"Processing table: {table_name}")
+            create_table_in_sqlite(conn, table_name, payload)
+        elif action == "insert":
+            write_data_to_sqlite(conn, payload, table_name)
+        else:
+            remaining -= 1
+            if payload:
+                # Nothing is durable until the load's single COMMIT
+                print(f"Fetched table: {table_name}")
 
-            # Write to SQLite
-            write_data_to_sqlite(converted_data, table_name)
 
-            print(f"Data successfully written for table: {table_name}")
+def main():
+    """
+    Main function to orchestrate the data transfer from Snowflake to SQLite.
+    """
+    snowflake_connection = snowflake_connection_helper()
+    print("Snowflake connection established.")
+    # Autocommit mode; the transaction is managed explicitly below
+    sqlite_conn = sqlite3.connect(
+        sqlite_db_path, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None
+    )
+    for pragma in sqlite_pragmas:
+        sqlite_conn.execute(pragma)
+
+    # Bounded so the fetch workers can't run far ahead of the writer
+    batches = queue.Queue(maxsize=max_workers * 2)
+    stop = threading.Event()
+
+    try:
+        # Load every table in a single transaction
+        sqlite_conn.execute("BEGIN")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    fetch_table, snowflake_connection, table_name, batches, stop
+                )
+                for table_name in table_names
+            ]
+            try:
+                write_batches_to_sqlite(sqlite_conn, batches, len(futures))
+            except BaseException:
+                # Unblock workers waiting on a full queue so they can exit
+                stop.set()
+                while not all(future.done() for future in futures):
+                    try:
+                        batches.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                raise
+
+        # Re-raise the first error from a fetch worker, if any
+        for future in futures:
+            future.result()
+
+        sqlite_conn.execute("COMMIT")
+        print(f"Committed {len(table_names)} tables to SQLite.")
     finally:
+        sqlite_conn.close()
         snowflake_connection.close()
         print("Snowflake connection closed.")
 
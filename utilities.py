@@ -1,10 +1,15 @@
+import sqlite3
 import streamlit as st
+import duckdb
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 import snowflake.connector
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 
 
 # Function to load the private key from secrets
+@st.cache_resource(ttl=86400)
 def load_private_key_from_secrets(private_key_str):
     """Function to take a plain text string of an RSA Private key and convert
        into the proper format needed for a connection string.
@@ -30,7 +35,7 @@ def snowflake_connection_helper():
         st.secrets["connections"]["snowflake"]["private_key"]
     )
 
-    # Set up the connection using the formatted private key, without caching the private key object
+    # Set up the connection using the formatted private key; the parsed key is cached separately
     conn = snowflake.connector.connect(
         account=st.secrets["connections"]["snowflake"]["account"],
         user=st.secrets["connections"]["snowflake"]["user"],
@@ -44,8 +49,65 @@ def snowflake_connection_helper():
     return conn
 
 
-def run_snowflake_query(_conn, query):
+# PRAGMAs applied to every pooled connection to the SQLite cache
+sqlite_pragmas = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+]
+
+
+# Registered on every Engine rather than one engine instance, so connections
+# from an engine Streamlit rebuilds (after a query error or secrets change)
+# are tuned too
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Only SQLite connections take these PRAGMAs
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in sqlite_pragmas:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+def get_sqlite_connection(name="jaffle_shop"):
+    """Open the SQLite cache connection; sqlite_pragmas are applied on connect.
+
+    Args:
+        name (str): The connection name in secrets.toml
+
+    Returns:
+        SQLConnection: Streamlit SQL connection to the SQLite cache
+    """
+    return st.connection(name, type="sql")
+
+
+# Result column names are lowercased so every backend returns the same casing
+# (Snowflake uppercases unquoted identifiers, SQLite and DuckDB keep them as written)
+@st.cache_data(ttl=600, show_spinner=False)
+def run_snowflake_query_arrow(_conn, query):
     with _conn.cursor() as cur:
         cur.execute(query)
-        result = cur.fetch_pandas_all()
+        # Keep the result columnar; empty results still come back as a table
+        result = cur.fetch_arrow_all(force_return_table=True)
+        return result.rename_columns([name.lower() for name in result.column_names])
+
+
+def run_sqlite_query(conn, query):
+    result = conn.query(query, ttl=600, show_spinner=False)
+    result.columns = result.columns.str.lower()
+    return result
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def run_duckdb_query(database, query):
+    with duckdb.connect(database) as conn:
+        result = conn.execute(query).df()
+        result.columns = result.columns.str.lower()
         return result